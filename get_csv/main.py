@@ -1,10 +1,11 @@
 import os
+import sys
 import time
+import shutil
+import argparse
+from urllib.parse import urljoin, urlparse
+import requests
 from dotenv import load_dotenv
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
 
 load_dotenv()
 
@@ -12,8 +13,71 @@ CSV_URL = os.getenv('CSV_URL')
 EMAIL = os.getenv('EMAIL')
 PASSWORD = os.getenv('PASSWORD')
 
+LOGIN_FORM_XPATH = '/html/body/div[3]/section[1]/div/div/form'
+LOGIN_INPUT_XPATH = LOGIN_FORM_XPATH + '/div[1]/div[1]/div/input'
+PASSWORD_INPUT_XPATH = LOGIN_FORM_XPATH + '/div[1]/div[2]/div/input'
+SUBMIT_BUTTON_XPATH = LOGIN_FORM_XPATH + '/div[2]/button'
+DOWNLOAD_LINK_XPATH = '/html/body/div[3]/div[1]/div[1]/a'
+
+
+def get_filename(response):
+    disposition = response.headers.get('content-disposition', '')
+    for part in disposition.split(';'):
+        key, _, value = part.strip().partition('=')
+        if key.lower() == 'filename' and value:
+            return os.path.basename(value.strip('"'))
+
+    filename = os.path.basename(urlparse(response.url).path)
+    if not filename.endswith('.csv'):
+        filename = 'products.csv'
+
+    return filename
+
+
+def download_with_requests():
+    import lxml.html
+
+    session = requests.Session()
+
+    # lOGIN
+    response = session.get(CSV_URL, timeout=30)
+    response.raise_for_status()
+
+    page = lxml.html.fromstring(response.content)
+    form = page.xpath(LOGIN_FORM_XPATH)[0]
+
+    # Keeps hidden fields such as CSRF tokens
+    data = dict(form.form_values())
+    data[page.xpath(LOGIN_INPUT_XPATH)[0].name] = EMAIL
+    data[page.xpath(PASSWORD_INPUT_XPATH)[0].name] = PASSWORD
+
+    submit_button = page.xpath(SUBMIT_BUTTON_XPATH)[0]
+    if submit_button.get('name'):
+        data[submit_button.get('name')] = submit_button.get('value', '')
+
+    response = session.post(
+        urljoin(response.url, form.get('action') or ''), data=data, timeout=30)
+    response.raise_for_status()
+
+    # DOWNLOAD
+    page = lxml.html.fromstring(response.content)
+    download_link = page.xpath(DOWNLOAD_LINK_XPATH)[0]
+
+    with session.get(urljoin(response.url, download_link.get('href')),
+                     stream=True, timeout=60) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+
+        with open(get_filename(response), 'wb') as csv_file:
+            shutil.copyfileobj(response.raw, csv_file)
+
+
+def download_with_selenium():
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
 
-def main():
     options = webdriver.ChromeOptions()
     options.add_argument('--headless')
 
@@ -22,14 +86,11 @@ def main():
     driver.get(CSV_URL)
 
     # lOGIN
-    login_input = driver.find_element(
-        By.XPATH, '/html/body/div[3]/section[1]/div/div/form/div[1]/div[1]/div/input')
+    login_input = driver.find_element(By.XPATH, LOGIN_INPUT_XPATH)
 
-    password_input = driver.find_element(
-        By.XPATH, '/html/body/div[3]/section[1]/div/div/form/div[1]/div[2]/div/input')
+    password_input = driver.find_element(By.XPATH, PASSWORD_INPUT_XPATH)
 
-    submit_button = driver.find_element(
-        By.XPATH, '/html/body/div[3]/section[1]/div/div/form/div[2]/button')
+    submit_button = driver.find_element(By.XPATH, SUBMIT_BUTTON_XPATH)
 
     # close_button = driver.find_element(
     #     By.XPATH, '/html/body/div[5]/p[1]/a')
@@ -41,11 +102,10 @@ def main():
 
     # DOWNLOAD
     element_present = EC.presence_of_element_located(
-        (By.XPATH, '/html/body/div[3]/div[1]/div[1]/a'))
+        (By.XPATH, DOWNLOAD_LINK_XPATH))
     WebDriverWait(driver, 5).until(element_present)
 
-    download_button = driver.find_element(
-        By.XPATH, '/html/body/div[3]/div[1]/div[1]/a')
+    download_button = driver.find_element(By.XPATH, DOWNLOAD_LINK_XPATH)
     download_button.click()
 
     time.sleep(5)
@@ -53,5 +113,22 @@ def main():
     driver.close()
 
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--selenium', action='store_true',
+                        help='log in with a headless Chrome instead of plain HTTP')
+    args = parser.parse_args()
+
+    if args.selenium:
+        download_with_selenium()
+        return
+
+    try:
+        download_with_requests()
+    except (requests.RequestException, IndexError) as e:
+        print('Error downloading CSV file', e, file=sys.stderr)
+        sys.exit(1)
+
+
 if __name__ == '__main__':
     main()
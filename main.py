@@ -1,192 +1,1152 @@
 import os
-import glob
-import json
-import csv
+import argparse
+import time
+import asyncio
+import hashlib
+import functools
+import contextlib
+import orjson
+import msgspec
 import openai
-import datetime
+import yaml
+import ahocorasick
+import numpy as np
+import polars as pl
+import tiktoken
+import diskcache
+import httpx
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, String, Double, DateTime, Integer
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import select, text, update, Column, Index, String, Double, DateTime, Integer
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.engine import URL
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, insert
 
 load_dotenv()
-openai.api_key = os.getenv('OPENAI_API_KEY')
 
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 20))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 200))
+OPENAI_MAX_KEEPALIVE = int(os.getenv('OPENAI_MAX_KEEPALIVE', 100))
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', 60))
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', 150000))
 
-def generate_product_category(product):
-    if product.category:
-        print('Product already has a category', product.category)
-        return product.category
+# Caps the HTTP requests in flight. Only the network call holds a slot, not
+# the local classifier, cache lookups or the backoff between retries.
+request_semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 500))
+ENRICH_CHUNK_SIZE = 200
+# Marketing tasks created ahead of the free request slots, the scan waits
+# beyond that so memory stays flat however many products are pending
+ENRICH_MAX_PENDING = 4 * OPENAI_CONCURRENCY
+ENRICH_PAGE_SIZE = 500
+CATEGORY_BATCH_SIZE = 20
+CATEGORY_BATCH_MAX_TOKENS = 3000
+BATCH_POLL_INTERVAL = 60
+# Batch API limits per input file
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 200 * 1024 * 1024
 
-    prompt = '''Strictly generate product category as an JSON respecting the given JSON structure {"category": <one of the value of [Proteine, Aminoacizi, Vitamine si Minerale, Batoane si Gustari Fitness, Suplimente pentru slabit, Performanta/Stimulatoare, Pre-Workout, Creatina, Imbracaminte si acesorii pentru sala, Masa musculara, Suplimente, Probiotice]>}
-Product input: 
-Manufacturer: ''' + product.manufacturer_name + '''
-Name: ''' + product.name
+# Categories only depend on manufacturer and name, keep them across runs
+category_cache = diskcache.Cache(
+    os.getenv('CATEGORY_CACHE_DIR', '.cache/categories'))
+
+# Marketing copy is keyed by the exact prompt, SKUs that only differ in
+# packaging share it
+marketing_cache = diskcache.Cache(
+    os.getenv('MARKETING_CACHE_DIR', '.cache/marketing'))
+# Ids of submitted batches whose results haven't been saved yet
+OPEN_BATCHES_KEY = 'open_batches'
+
+EMBEDDING_MODEL = 'text-embedding-3-small'
+EMBEDDING_DIMENSIONS = 1536
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.9))
+
+CATEGORY_KEYWORDS_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'category_keywords.yaml')
+
+# How many products the keyword list matched, for tuning it
+classifier_stats = {'local': 0, 'unmatched': 0}
+
+CATEGORY_CHOICES = [
+    'Proteine', 'Aminoacizi', 'Vitamine si Minerale',
+    'Batoane si Gustari Fitness', 'Suplimente pentru slabit',
+    'Performanta/Stimulatoare', 'Pre-Workout', 'Creatina',
+    'Imbracaminte si acesorii pentru sala', 'Masa musculara', 'Suplimente',
+    'Probiotice',
+]
+
+# The static part of the prompts is built once, only the product fields are
+# formatted in per call
+CATEGORY_PROMPT_TEMPLATE = (
+    'Strictly generate the product category of every product below as an JSON '
+    'respecting the given JSON structure {{"results": [{{"index": <number of '
+    'the product line>, "category": <one of the value of ['
+    + ', '.join(CATEGORY_CHOICES) + ']>}}]}}\n'
+    'Products input:\n'
+    '{products}'
+)
+
+# Same for every request, shared instead of rebuilt per call
+SYSTEM_MESSAGE = {"role": "system",
+                  "content": "You are a fitness nutrition marketing specialist."}
+
+CATEGORY_PRODUCT_TEMPLATE = (
+    '{index}. Manufacturer: {manufacturer_name}, Name: {name}'
+)
+
+MARKETING_PROMPT_TEMPLATE = (
+    'Generate product details using Romanian language and respecting the given '
+    'JSON structure {{"html_description":<formatted string min 600 tokens max '
+    '900 tokens>, "meta_title":  <string no more than 25 tokens length>, '
+    '"meta_description": <string no more than 55 tokens length>, '
+    '"weight": "<string>"}}.\n'
+    'Product details input:\n'
+    '"{manufacturer_name}",\n"name": "{name}",\n"flavour": "{flavour}"\n\n'
+    'Output:'
+)
+
+CSV_COLUMNS = ('sku', 'manufacturer_name', 'name', 'qty',
+               'flavour', 'img_url', 'retail_price')
+
+# Timestamps have always been stored as naive UTC. now() is the start of the
+# transaction, so every row written by one batch shares the same timestamp.
+UTC_NOW = text("timezone('utc', now())")
+
+# Empty strings count as missing, OpenAI sometimes leaves a field out. The
+# parentheses keep the ORs together when a query ANDs more onto it.
+NEEDS_ENRICHMENT = text(
+    "(coalesce(description, '') = '' OR coalesce(meta_title, '') = '' "
+    "OR coalesce(meta_description, '') = '')")
+
+Base = declarative_base()
+
+
+class Product(Base):
+    __tablename__ = 'products'
+    __table_args__ = (
+        # Partial index over the rows still waiting for marketing copy. It
+        # carries the prompt columns too, so the enrichment scan is an index
+        # only scan instead of a walk over the whole table.
+        Index('ix_products_needs_enrich', 'sku',
+              postgresql_include=['manufacturer_name', 'name', 'flavour'],
+              postgresql_where=NEEDS_ENRICHMENT),
+    )
+
+    sku = Column(String(), primary_key=True)
+    manufacturer_name = Column(String())
+    name = Column(String())
+    qty = Column(String())
+    flavour = Column(String())
+    weight = Column(String())
+    img_url = Column(String())
+    retail_price = Column(Double())
+    description = Column(String())
+    meta_title = Column(String())
+    meta_description = Column(String())
+    created_at = Column(DateTime, server_default=UTC_NOW)
+    updated_at = Column(DateTime, server_default=UTC_NOW, onupdate=UTC_NOW)
+    openai_response = Column(JSONB)
+    total_tokens = Column(Integer)
+    category = Column(String())
+
+
+class AsyncLeakyBucket:
+    # Sliding request/token budget refilled continuously over a minute. The
+    # limits back off by half on a 429 and creep back up on every success.
+
+    def __init__(self, rpm, tpm):
+        self.max_rpm = rpm
+        self.max_tpm = tpm
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.updated_at = time.monotonic()
+        self.condition = asyncio.Condition()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens):
+        async with self.condition:
+            while True:
+                self.refill()
+
+                # A single request larger than the budget would never fit
+                needed = min(tokens, self.tpm)
+                if self.requests >= 1 and self.tokens >= needed:
+                    self.requests -= 1
+                    self.tokens -= needed
+                    return
+
+                wait = max((1 - self.requests) * 60 / self.rpm,
+                           (needed - self.tokens) * 60 / self.tpm)
+                try:
+                    await asyncio.wait_for(self.condition.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def on_rate_limited(self):
+        async with self.condition:
+            self.rpm = max(1, self.rpm / 2)
+            self.tpm = max(self.max_tpm / self.max_rpm, self.tpm / 2)
+            self.requests = min(self.requests, self.rpm)
+            self.tokens = min(self.tokens, self.tpm)
+            print('Rate limited, lowering limits to', self.rpm, 'RPM', self.tpm, 'TPM')
+
+    async def on_success(self):
+        async with self.condition:
+            self.rpm = min(self.max_rpm, self.rpm + 1)
+            self.tpm = min(self.max_tpm, self.tpm + self.max_tpm / self.max_rpm)
+            self.condition.notify_all()
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.encoding_for_model('gpt-3.5-turbo')
+
+
+def estimate_tokens(prompt, max_tokens):
+    # The completion counts against the TPM budget too
+    return len(get_encoding().encode(prompt)) + max_tokens
+
+
+class KeyRotator:
+    # Hands out one client per API key round-robin, a key that got a 429
+    # sits out for the retry-after period the API asked for
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.next_index = 0
+        self.sidelined_until = [0.0] * len(clients)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for client in self.clients:
+            await client.close()
+
+    async def next_available(self):
+        while True:
+            now = time.monotonic()
+
+            for offset in range(len(self.clients)):
+                index = (self.next_index + offset) % len(self.clients)
+                if self.sidelined_until[index] <= now:
+                    self.next_index = index + 1
+                    return index
+
+            await asyncio.sleep(min(self.sidelined_until) - now)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        index = await self.next_available()
+
+        try:
+            yield self.clients[index]
+        except openai.RateLimitError as e:
+            retry_after = e.response.headers.get('retry-after')
+            try:
+                retry_after = float(retry_after)
+            except (TypeError, ValueError):
+                retry_after = 20.0
+
+            print('API key', index, 'rate limited for', retry_after, 'seconds')
+            self.sidelined_until[index] = time.monotonic() + retry_after
+            raise
+
+
+def get_api_keys():
+    keys = []
+
+    # OPENAI_API_KEY, OPENAI_API_KEY_1, OPENAI_API_KEY_2, ...
+    for name in sorted(os.environ):
+        value = os.environ[name]
+        if name.startswith('OPENAI_API_KEY') and value and value not in keys:
+            keys.append(value)
+
+    if not keys:
+        raise RuntimeError('OPENAI_API_KEY is not set')
+
+    return keys
+
+
+def configure_openai():
+    clients = []
+
+    for api_key in get_api_keys():
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(30.0),
+        )
+
+        # Retries are handled by tenacity on request_chat_completion
+        clients.append(openai.AsyncOpenAI(
+            api_key=api_key,
+            http_client=http_client,
+            max_retries=0,
+        ))
+
+    return KeyRotator(clients)
+
+
+def configure_limiter(rotator):
+    # Rate limits are enforced per key, so the budget grows with the pool
+    keys = len(rotator.clients)
+    return AsyncLeakyBucket(OPENAI_RPM * keys, OPENAI_TPM * keys)
+
+
+class SemanticCache:
+    # Nearest neighbour lookup over the embeddings of earlier inputs, kept in
+    # memory as one matrix and saved into a diskcache entry
+
+    def __init__(self, cache, key, threshold):
+        self.cache = cache
+        self.key = key
+        self.threshold = threshold
+        self.embeddings, self.values = cache.get(
+            key, (np.empty((0, EMBEDDING_DIMENSIONS), dtype=np.float32), []))
+        self.dirty = False
+
+    def lookup(self, embedding):
+        if not self.values:
+            return None
+
+        similarities = self.embeddings @ embedding
+        index = int(np.argmax(similarities))
+        if similarities[index] >= self.threshold:
+            return self.values[index]
+
+        return None
+
+    def add(self, embedding, value):
+        self.embeddings = np.vstack([self.embeddings, embedding])
+        self.values.append(value)
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            self.cache.set(self.key, (self.embeddings, self.values))
+            self.dirty = False
+
+
+category_semantic_cache = SemanticCache(
+    category_cache, 'semantic_index', SEMANTIC_CACHE_THRESHOLD)
+
+
+def build_messages(prompt):
+    return [
+        SYSTEM_MESSAGE,
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+openai_retry = retry(
+    stop=stop_after_attempt(5),
+    # 1s, 2s, 4s, ... plus jitter so concurrent retries don't line up
+    wait=wait_exponential_jitter(1, 30),
+    retry=retry_if_exception_type(
+        (openai.RateLimitError, openai.APIConnectionError)),
+    reraise=True,
+)
+
+
+@openai_retry
+async def request_chat_completion(rotator, limiter, prompt, temperature, max_tokens, timeout):
+    async with request_semaphore:
+        await limiter.acquire(estimate_tokens(prompt, max_tokens))
+
+        try:
+            async with rotator.acquire() as client:
+                # The raw body is parsed once with orjson, building the SDK's
+                # pydantic models only to dump them back into a dict is waste
+                response = await client.chat.completions.with_raw_response.create(
+                    model="gpt-3.5-turbo",
+                    messages=build_messages(prompt),
+                    temperature=temperature,
+                    frequency_penalty=0.5,
+                    max_tokens=max_tokens,
+                    timeout=timeout,
+                )
+        except openai.RateLimitError:
+            await limiter.on_rate_limited()
+            raise
+
+        await limiter.on_success()
+        return orjson.loads(response.content)
+
+
+@openai_retry
+async def request_embeddings(rotator, limiter, texts):
+    # One request for a whole chunk, normalized so a dot product is the
+    # cosine similarity
+    async with request_semaphore:
+        await limiter.acquire(sum(len(get_encoding().encode(text)) for text in texts))
+
+        try:
+            async with rotator.acquire() as client:
+                response = await client.embeddings.create(
+                    model=EMBEDDING_MODEL, input=texts)
+        except openai.RateLimitError:
+            await limiter.on_rate_limited()
+            raise
+
+        await limiter.on_success()
+
+    embeddings = np.array([item.embedding for item in response.data], dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def clean_json_block(content):
+    # The model sometimes wraps its JSON in a ```json ... ``` markdown block,
+    # slice between the first line and the closing fence
+    content = content.strip()
+
+    if content.startswith('```'):
+        first_newline = content.find('\n')
+        last_fence = content.rfind('```')
+        if first_newline != -1 and last_fence > first_newline:
+            return content[first_newline + 1:last_fence].strip()
+
+    return content
+
+
+def parse_json_content(content):
+    return orjson.loads(clean_json_block(content))
+
+
+class MarketingDetails(msgspec.Struct):
+    # Replies sometimes use the Romanian field names, anything else the
+    # model adds is skipped by the decoder
+    html_description: str | None = None
+    descriere: str | None = None
+    meta_title: str | None = None
+    meta_titlu: str | None = None
+    meta_description: str | None = None
+    meta_descriere: str | None = None
+    # Asked for as a string, but a bare number is good enough
+    weight: str | int | float | None = None
+
+
+marketing_decoder = msgspec.json.Decoder(MarketingDetails)
+
+
+@functools.lru_cache(maxsize=None)
+def get_category_automaton():
+    with open(CATEGORY_KEYWORDS_FILE) as keywords_file:
+        keywords = yaml.safe_load(keywords_file)
+
+    automaton = ahocorasick.Automaton()
+    for category, words in keywords.items():
+        for word in words:
+            automaton.add_word(word.lower(), (word.lower(), category))
+
+    automaton.make_automaton()
+    return automaton
+
+
+def local_classify(text):
+    # Padding keeps the word boundary checks inside the string
+    text = ' ' + text.lower() + ' '
+    matches = []
+
+    for end, (word, category) in get_category_automaton().iter(text):
+        start = end - len(word) + 1
+        if text[start - 1].isalnum() or text[end + 1].isalnum():
+            continue
+
+        matches.append((start, end, category))
+
+    # A keyword inside a longer one doesn't count, "protein" in "protein
+    # bar". Anything else pointing at two categories, like "protein
+    # cookie", is left to OpenAI.
+    categories = {
+        category for start, end, category in matches
+        if not any(other_start <= start and end <= other_end
+                   and other_end - other_start > end - start
+                   for other_start, other_end, _ in matches)
+    }
+
+    if len(categories) == 1:
+        return categories.pop()
+
+    return None
+
+
+def build_category_line(index, product):
+    # The columns are nullable, a NULL must not reach the prompt as 'None'
+    return CATEGORY_PRODUCT_TEMPLATE.format(
+        index=index,
+        manufacturer_name=product.manufacturer_name or '', name=product.name or '')
+
+
+def build_category_prompt(products):
+    return CATEGORY_PROMPT_TEMPLATE.format(products='\n'.join(
+        build_category_line(index, product)
+        for index, product in enumerate(products, start=1)))
+
+
+def build_marketing_prompt(product):
+    return MARKETING_PROMPT_TEMPLATE.format(
+        manufacturer_name=product.manufacturer_name or '', name=product.name or '',
+        flavour=product.flavour or '')
+
+
+def find_cached_category(product):
+    # Local lookups only, the semantic cache needs embeddings which are
+    # requested for a whole chunk of misses at once
+    # Brands like Iron Maxx or The Protein Works would outvote the name
+    category = local_classify(product.name or '')
+    if category:
+        print('Local product category', category)
+        classifier_stats['local'] += 1
+        return category
+
+    classifier_stats['unmatched'] += 1
+
+    key = (product.manufacturer_name, product.name)
+    category = category_cache.get(key)
+    if category:
+        print('Cached product category', category)
+
+    return category
+
+
+def chunk_category_products(products):
+    # Up to CATEGORY_BATCH_SIZE products per request, cut early when the
+    # product list alone gets near CATEGORY_BATCH_MAX_TOKENS
+    chunk = []
+    tokens = 0
+
+    for product in products:
+        line_tokens = len(get_encoding().encode(
+            build_category_line(len(chunk) + 1, product)))
+
+        if chunk and (len(chunk) == CATEGORY_BATCH_SIZE
+                      or tokens + line_tokens > CATEGORY_BATCH_MAX_TOKENS):
+            yield chunk
+            chunk = []
+            tokens = 0
+
+        chunk.append(product)
+        tokens += line_tokens
+
+    if chunk:
+        yield chunk
+
+
+async def classify_category_chunk(rotator, limiter, products):
+    # Names that differ in size or flavour wording land next to each other,
+    # only what the semantic cache can't place is sent to the chat model
+    try:
+        embeddings = await request_embeddings(
+            rotator, limiter,
+            [f'{product.manufacturer_name} {product.name}' for product in products])
+    except Exception as e:
+        print('Error embedding product names', e)
+        return await generate_product_categories(rotator, limiter, products, {})
+
+    embeddings = dict(zip((product.sku for product in products), embeddings))
+
+    updates = []
+    misses = []
+    for product in products:
+        category = category_semantic_cache.lookup(embeddings[product.sku])
+        if category:
+            print('Similar product category', category)
+            category_cache.set((product.manufacturer_name, product.name), category)
+            updates.append({'sku': product.sku, 'category': category})
+        else:
+            misses.append(product)
+
+    if misses:
+        updates.extend(await generate_product_categories(
+            rotator, limiter, misses, embeddings))
+
+    return updates
+
+
+async def generate_product_categories(rotator, limiter, products, embeddings):
+    prompt = build_category_prompt(products)
     print('Prompt', prompt)
 
     response = None
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system",
-                 "content": "You are a fitness nutrition marketing specialist."},
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            temperature=0.2,
-            frequency_penalty=0.5,
-            max_tokens=200,
-            request_timeout=5,
-        )
+        response = await request_chat_completion(
+            rotator, limiter, prompt, temperature=0.2,
+            max_tokens=40 * len(products) + 50, timeout=5 + len(products))
+    except Exception as e:
+        print('Error generating product categories', e)
+        return []
+
+    print('Response', response)
+
+    # No content at all when the reply was cut by the content filter
+    response_content = response['choices'][0]['message'].get('content') or ''
+    print('Response content', response_content)
+
+    try:
+        response_as_json = parse_json_content(response_content)
+    except orjson.JSONDecodeError as e:
+        print('Error parsing product categories', e)
+        return []
+
+    # Tolerate the bare list some replies come back as
+    if isinstance(response_as_json, dict):
+        response_as_json = response_as_json.get('results')
+    if not isinstance(response_as_json, list):
+        print('Unexpected product categories', response_as_json)
+        return []
+
+    # Answers are matched on the line number, an echoed SKU can lose its
+    # leading zeros on the way back
+    categories = {}
+    for result in response_as_json:
+        if not isinstance(result, dict) or not result.get('category'):
+            continue
+
+        try:
+            index = int(result.get('index'))
+        except (TypeError, ValueError):
+            continue
+
+        if 1 <= index <= len(products):
+            categories[products[index - 1].sku] = result['category']
+
+    # The response is shared by the whole chunk, split its token usage
+    total_tokens = response['usage']['total_tokens'] // len(products)
+
+    updates = []
+    for product in products:
+        category = categories.get(product.sku)
+        updates.append({
+            'sku': product.sku,
+            'category': category,
+            'openai_response': response,
+            'total_tokens': total_tokens,
+        })
+
+        if not category:
+            continue
+
+        category_cache.set((product.manufacturer_name, product.name), category)
+        if embeddings.get(product.sku) is not None:
+            category_semantic_cache.add(embeddings[product.sku], category)
+
+    return updates
+
+
+async def enrich_product_marketing(rotator, limiter, product):
+    prompt = build_marketing_prompt(product)
+
+    key = hashlib.sha256(prompt.encode()).hexdigest()
+    cached = marketing_cache.get(key)
+    if cached:
+        print('Cached product details', product.sku)
+        return build_marketing_update(product.sku, *cached)
+
+    print('Prompt', prompt)
+
+    response = None
+    try:
+        response = await request_chat_completion(
+            rotator, limiter, prompt, temperature=0.7, max_tokens=750, timeout=15)
     except Exception as e:
-        print('Error generating product category', e)
+        print('Error generating product details', e)
         return None
 
     print('Response', response)
 
-    product.openai_response = response
-    product.total_tokens = response['usage']['total_tokens']
+    cached = (response['choices'][0]['message']['content'],
+              response, response['usage']['total_tokens'])
+    enrichment = build_marketing_update(product.sku, *cached)
+    # An incomplete reply is saved but not cached, NEEDS_ENRICHMENT picks the
+    # product up again on the next run and it has to reach OpenAI then
+    if enrichment is not None and all(
+            enrichment[field]
+            for field in ('description', 'meta_title', 'meta_description')):
+        marketing_cache.set(key, cached)
 
-    response_content = response['choices'][0]['message']['content']
+    return enrichment
+
+
+def get_first_present(*values):
+    # The English field is sometimes left blank next to a filled Romanian
+    # one. isspace() checks without building a stripped copy.
+    for value in values:
+        if value and not value.isspace():
+            return value
+
+    return ''
+
+
+def build_marketing_update(sku, response_content, openai_response, total_tokens):
+    response_content = response_content.strip()
     print('Response content', response_content)
 
-    response_as_json = json.loads(response_content)
-    return response_as_json.get('category', '')
+    try:
+        details = marketing_decoder.decode(clean_json_block(response_content))
+    except msgspec.DecodeError as e:
+        print('Error parsing product details', e)
+        return None
 
+    return {
+        'sku': sku,
+        'description': get_first_present(details.html_description, details.descriere),
+        'meta_title': get_first_present(details.meta_title, details.meta_titlu),
+        'meta_description': get_first_present(
+            details.meta_description, details.meta_descriere),
+        'weight': get_first_present(
+            None if details.weight is None else str(details.weight)),
+        'openai_response': openai_response,
+        'total_tokens': total_tokens,
+    }
 
-def main():
-    url = URL.create(
-        drivername='postgresql',
+
+async def categorize_products(session, products):
+    async with configure_openai() as rotator:
+        limiter = configure_limiter(rotator)
+
+        # Same manufacturer and name means the same prompt line, only the
+        # first product of each group is looked up and sent to OpenAI
+        groups = {}
+        for product in products:
+            groups.setdefault(
+                (product.manufacturer_name, product.name), []).append(product)
+
+        updates = []
+        misses = []
+        duplicates = {}
+        for group in groups.values():
+            category = find_cached_category(group[0])
+            if category:
+                updates.extend(
+                    {'sku': product.sku, 'category': category} for product in group)
+            else:
+                misses.append(group[0])
+                duplicates[group[0].sku] = group[1:]
+
+        if updates:
+            await save_updates(session, updates)
+
+        coros = [classify_category_chunk(rotator, limiter, chunk)
+                 for chunk in chunk_category_products(misses)]
+
+        # Categories are committed as they come in instead of after the
+        # slowest request
+        updates = []
+        for future in asyncio.as_completed(coros):
+            for mapping in await future:
+                updates.append(mapping)
+                updates.extend(
+                    {'sku': product.sku, 'category': mapping['category']}
+                    for product in duplicates[mapping['sku']])
+
+            if len(updates) >= ENRICH_CHUNK_SIZE:
+                await save_updates(session, updates)
+                updates = []
+
+    if updates:
+        await save_updates(session, updates)
+    category_semantic_cache.save()
+
+    total = classifier_stats['local'] + classifier_stats['unmatched']
+    if total:
+        print('Local classifier hit rate',
+              f"{classifier_stats['local']}/{total}")
+
+
+async def save_updates(session, updates):
+    await session.execute(update(Product), updates)
+    await session.commit()
+
+
+async def enrich_products(session):
+    updates = []
+    pending = set()
+    finished = []
+    saving = None
+
+    def on_done(task):
+        pending.discard(task)
+        finished.append(task)
+
+    async def wait_for_save():
+        try:
+            await saving
+        except BaseException:
+            # Don't keep paying for replies that can't be written
+            for task in pending:
+                task.cancel()
+            raise
+
+    async def collect():
+        # Results are written as they come in, one UPDATE per chunk. The
+        # write runs in the background so the scan keeps dispatching
+        # requests while Postgres commits.
+        nonlocal updates, saving
+
+        if saving is not None and saving.done():
+            await wait_for_save()
+
+        while finished:
+            enrichment = finished.pop().result()
+            if enrichment is not None:
+                updates.append(enrichment)
+
+            if len(updates) >= ENRICH_CHUNK_SIZE:
+                # The session runs one statement at a time, so only one
+                # write is in flight and its error surfaces here
+                if saving is not None:
+                    await wait_for_save()
+                saving = asyncio.create_task(save_updates(session, updates))
+                updates = []
+
+    async with configure_openai() as rotator:
+        limiter = configure_limiter(rotator)
+
+        # Requests start with the first page. Pages are read by sku, each
+        # in a short transaction of its own, a cursor held open for the
+        # whole pass would pin one snapshot for hours while every row gets
+        # updated. Plain rows are enough for the prompt and cheaper than ORM
+        # instances.
+        query = (
+            select(Product.sku, Product.manufacturer_name,
+                   Product.name, Product.flavour)
+            .where(NEEDS_ENRICHMENT)
+            .order_by(Product.sku)
+            .limit(ENRICH_PAGE_SIZE))
+        page = None
+
+        while page is None or len(page) == ENRICH_PAGE_SIZE:
+            page_query = query if page is None else query.where(Product.sku > page[-1].sku)
+            async with session.bind.connect() as connection:
+                page = (await connection.execute(page_query)).all()
+
+            for product in page:
+                while len(pending) >= ENRICH_MAX_PENDING:
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    await collect()
+
+                task = asyncio.create_task(
+                    enrich_product_marketing(rotator, limiter, product))
+                task.add_done_callback(on_done)
+                pending.add(task)
+
+                await collect()
+
+        while pending or finished:
+            if not finished:
+                await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            await collect()
+
+    if saving is not None:
+        await wait_for_save()
+    if updates:
+        await save_updates(session, updates)
+
+
+def build_marketing_batches(products):
+    # One JSONL input file per batch, cut at the Batch API limits
+    lines = []
+    size = 0
+
+    for product in products:
+        line = orjson.dumps({
+            'custom_id': product.sku,
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': {
+                'model': 'gpt-3.5-turbo',
+                'messages': build_messages(build_marketing_prompt(product)),
+                'temperature': 0.7,
+                'frequency_penalty': 0.5,
+                'max_tokens': 750,
+            },
+        })
+
+        if lines and (len(lines) == BATCH_MAX_REQUESTS
+                      or size + len(line) + 1 > BATCH_MAX_BYTES):
+            yield b'\n'.join(lines)
+            lines = []
+            size = 0
+
+        lines.append(line)
+        size += len(line) + 1
+
+    if lines:
+        yield b'\n'.join(lines)
+
+
+async def wait_for_batch(client, batch_id):
+    batch = await client.batches.retrieve(batch_id)
+
+    while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await client.batches.retrieve(batch_id)
+        print('Batch', batch.id, batch.status, batch.request_counts)
+
+    return batch
+
+
+async def save_batch_output(session, output):
+    updates = []
+    for line in output.splitlines():
+        record = orjson.loads(line)
+        body = (record.get('response') or {}).get('body')
+        if not body or record.get('error'):
+            print('Error generating product details', record['custom_id'], record.get('error'))
+            continue
+
+        enrichment = build_marketing_update(
+            record['custom_id'], body['choices'][0]['message']['content'],
+            body, body['usage']['total_tokens'])
+        if enrichment is None:
+            continue
+
+        updates.append(enrichment)
+        if len(updates) >= ENRICH_CHUNK_SIZE:
+            await save_updates(session, updates)
+            updates = []
+
+    if updates:
+        await save_updates(session, updates)
+
+
+async def enrich_products_batch(session):
+    # Same work as enrich_products through the Batch API, half the price but
+    # results can take up to 24 hours
+    async with configure_openai() as rotator:
+        # Batches can only be read back with the key that created them
+        client = rotator.clients[0]
+
+        # Batches still open from an earlier run are collected instead of
+        # submitting their products a second time
+        batch_ids = marketing_cache.get(OPEN_BATCHES_KEY, [])
+        if batch_ids:
+            print('Resuming batches', batch_ids)
+        else:
+            result = await session.execute(
+                select(Product.sku, Product.manufacturer_name,
+                       Product.name, Product.flavour)
+                .where(NEEDS_ENRICHMENT))
+            products = result.all()
+            # Don't sit in a transaction while the batches run
+            await session.commit()
+
+            for index, content in enumerate(build_marketing_batches(products)):
+                batch_file = await client.files.create(
+                    file=(f'marketing-{index}.jsonl', content), purpose='batch')
+                batch = await client.batches.create(
+                    input_file_id=batch_file.id,
+                    endpoint='/v1/chat/completions',
+                    completion_window='24h')
+                print('Created batch', batch.id, 'with', content.count(b'\n') + 1, 'products')
+
+                # Recorded straight away, a run that dies while polling
+                # picks the batch up again
+                batch_ids.append(batch.id)
+                marketing_cache.set(OPEN_BATCHES_KEY, batch_ids)
+
+        for batch_id in list(batch_ids):
+            batch = await wait_for_batch(client, batch_id)
+
+            if batch.output_file_id:
+                output = await client.files.content(batch.output_file_id)
+                await save_batch_output(session, output.text)
+            else:
+                print('Batch', batch.id, 'finished without output', batch.status)
+
+            batch_ids.remove(batch_id)
+            marketing_cache.set(OPEN_BATCHES_KEY, batch_ids)
+
+
+async def upsert_products(session, rows):
+    # Existing products only get their stock updated, like the COPY merge
+    stmt = insert(Product)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['sku'],
+        set_={
+            'qty': stmt.excluded.qty,
+            'updated_at': UTC_NOW,
+        },
+    )
+
+    await session.execute(stmt, list(rows))
+    await session.commit()
+
+
+def iter_csv_batches(csv_path, batch_size=16_384):
+    # Parsed by Polars in batches. Every column stays a string except the
+    # price, asyncpg doesn't let Postgres cast text into the double column.
+    # Empty fields come back as null, they have always been stored as ''.
+    query = (
+        pl.scan_csv(csv_path, separator=';', infer_schema=False)
+        .select(CSV_COLUMNS)
+        .with_columns(
+            pl.exclude('retail_price').fill_null(''),
+            pl.col('retail_price').cast(pl.Float64),
+        )
+    )
+
+    yield from query.collect_batches(chunk_size=batch_size)
+
+
+async def copy_products(session, batches):
+    # Rows are numbered in load order so duplicated SKUs can be resolved
+    # to their last occurrence, ON CONFLICT can't touch a row twice
+    await session.execute(text(
+        'CREATE TEMP TABLE products_staging '
+        '(LIKE products INCLUDING DEFAULTS, line bigserial) ON COMMIT DROP'))
+
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    copied = 0
+
+    for batch in batches:
+        await raw_connection.driver_connection.copy_records_to_table(
+            'products_staging', records=batch.iter_rows(),
+            columns=CSV_COLUMNS)
+        copied += batch.height
+
+    columns = ', '.join(CSV_COLUMNS)
+    await session.execute(text(f'''
+        INSERT INTO products ({columns})
+        SELECT DISTINCT ON (sku) {columns}
+        FROM products_staging
+        ORDER BY sku, line DESC
+        ON CONFLICT (sku) DO UPDATE SET qty = EXCLUDED.qty'''))
+
+    return copied
+
+
+def find_csv_file():
+    # DirEntry.stat() is cached, so every file is stat'ed once
+    entries = [(entry.stat().st_mtime, entry.path) for entry in os.scandir('.')
+               if entry.name.endswith('.csv') and entry.is_file()]
+
+    if not entries:
+        raise FileNotFoundError('No CSV file found')
+
+    newest = max(entries)[1]
+    if len(entries) > 1:
+        print('Found', len(entries), 'CSV files, using the newest', newest)
+
+    return newest
+
+
+def get_database_url():
+    return URL.create(
+        drivername='postgresql+asyncpg',
         host='localhost',
         username=os.getenv('PG_USERNAME'),
         password=os.getenv('PG_PASSWORD'),
         database=os.getenv('PG_DATABASE')
     )
 
-    engine = create_engine(url)
-    engine.connect()
-
-    Base = declarative_base()
-
-    class Product(Base):
-        __tablename__ = 'products'
-
-        sku = Column(String(), primary_key=True)
-        manufacturer_name = Column(String())
-        name = Column(String())
-        qty = Column(String())
-        flavour = Column(String())
-        weight = Column(String())
-        img_url = Column(String())
-        retail_price = Column(Double())
-        description = Column(String())
-        meta_title = Column(String())
-        meta_description = Column(String())
-        created_at = Column(DateTime, default=datetime.datetime.utcnow)
-        updated_at = Column(DateTime, default=datetime.datetime.utcnow)
-        openai_response = Column(JSONB)
-        total_tokens = Column(Integer)
-        category = Column(String())
-
-    Base.metadata.create_all(engine)
-
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    csv_file = glob.glob('*.csv')[0]
-
-    with open(csv_file, newline='') as csv_file:
-        reader = csv.DictReader(csv_file, delimiter=';')
-
-        for row in reader:
-            sku = row['sku']
-            manufacturer_name = row['manufacturer_name']
-            name = row['name']
-            qty = row['qty']
-            flavour = row['flavour']
-            img_url = row['img_url']
-            retail_price = row['retail_price']
-
-            product = session.get(Product, sku)
-
-            if product:
-                product.qty = qty
-                product.category = generate_product_category(product)
-                session.commit()
-                continue
-
-            new_product = Product(
-                sku=sku,
-                manufacturer_name=manufacturer_name,
-                name=name,
-                qty=qty,
-                flavour=flavour,
-                img_url=img_url,
-                retail_price=retail_price,
-            )
-
-            new_product.category = generate_product_category(new_product)
-            session.add(new_product)
-            session.commit()
-
-    products = session.query(Product).all()
 
-    for product in products:
-        if product.description and product.meta_title and product.meta_description:
-            continue
+def configure_engine():
+    # The connections sit idle while OpenAI answers, the keepalives stop
+    # proxies and NATs in front of Postgres from dropping them. asyncpg has
+    # no libpq keepalive options, the server side settings do the same job.
+    return create_async_engine(
+        get_database_url(),
+        pool_size=5,
+        max_overflow=0,
+        pool_recycle=1800,
+        # openai_response holds the whole reply, marketing copy included.
+        # orjson encodes it for the JSONB column far quicker than json.dumps.
+        json_serializer=lambda value: orjson.dumps(value).decode(),
+        json_deserializer=orjson.loads,
+        connect_args={
+            'server_settings': {
+                'tcp_keepalives_idle': '30',
+                'tcp_keepalives_interval': '10',
+                'tcp_keepalives_count': '5',
+            },
+        },
+    )
 
-        prompt = """Generate product details using Romanian language and respecting the given JSON structure {"html_description":<formatted string min 600 tokens max 900 tokens>, "meta_title":  <string no more than 25 tokens length>, "meta_description": <string no more than 55 tokens length>, "weight": "<string>"}. 
-Product details input:
-""" + f""""{product.manufacturer_name}",\n"name": "{product.name}",\n"flavour": "{product.flavour}"\n""" + """
-Output:"""
-        print('Prompt', prompt)
 
-        response = None
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system",
-                        "content": "You are a fitness nutrition marketing specialist."},
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.7,
-                frequency_penalty=0.5,
-                max_tokens=750,
-                request_timeout=15,
-            )
-        except Exception as e:
-            print('Error generating product details', e)
-            continue
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='number of CSV rows per transaction')
+    parser.add_argument('--batch-api', action='store_true',
+                        help='generate marketing copy through the OpenAI Batch API')
+    return parser.parse_args()
 
-        print('Response', response)
 
-        product.openai_response = response
-        product.total_tokens = response['usage']['total_tokens']
+async def main_async(args):
+    engine = configure_engine()
 
-        response_content = response['choices'][0]['message']['content'].strip()
-        print('Response content', response_content)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        for index in Product.__table__.indexes:
+            await connection.run_sync(index.create, checkfirst=True)
 
-        response_as_json = json.loads(response_content)
+        # create_all leaves existing tables alone, databases created before
+        # the timestamps moved server side still need their defaults
+        for column in ('created_at', 'updated_at'):
+            await connection.execute(text(
+                f"ALTER TABLE products ALTER COLUMN {column} "
+                "SET DEFAULT timezone('utc', now())"))
 
-        product.description = response_as_json.get(
-            'html_description', response_as_json.get('descriere', ''))
-        product.meta_title = response_as_json.get(
-            'meta_title', response_as_json.get('meta_titlu', ''))
-        product.meta_description = response_as_json.get(
-            'meta_description', response_as_json.get('meta_descriere', ''))
-        product.weight = response_as_json.get('weight', '')
-        product.updated_at = datetime.datetime.utcnow()
+    # Instances stay usable after a commit, reloading them would need an
+    # await the attribute access can't do
+    Session = async_sessionmaker(engine, expire_on_commit=False)
 
-        session.commit()
+    csv_file = find_csv_file()
+
+    async with Session() as session:
+        if (await session.execute(select(Product.sku).limit(1))).first() is None:
+            # Fresh import, load the whole feed with COPY, only the products
+            # that still need OpenAI are read back afterwards
+            print('Copied products', await copy_products(session, iter_csv_batches(csv_file)))
+            await session.commit()
+        else:
+            # One INSERT ... ON CONFLICT per batch, a SKU repeated inside a
+            # batch keeps its last row since a statement can't touch it twice
+            for batch in iter_csv_batches(csv_file, args.batch_size):
+                rows = {row['sku']: row for row in batch.to_dicts()}
+                await upsert_products(session, rows.values())
+
+        # Plain rows like the enrichment scan, categories are written back
+        # with a bulk UPDATE by primary key
+        uncategorized = (await session.execute(
+            select(Product.sku, Product.manufacturer_name, Product.name)
+            .where(Product.category.is_(None)))).all()
+
+        # OpenAI calls are network bound, so they run concurrently once the
+        # whole feed is in the database instead of one by one inside the loop
+        await categorize_products(session, uncategorized)
+
+        if args.batch_api:
+            await enrich_products_batch(session)
+        else:
+            # The database and OpenAI share one event loop, chunk commits
+            # overlap with the requests still in flight
+            await enrich_products(session)
+
+    await engine.dispose()
+
+
+def main():
+    asyncio.run(main_async(parse_args()))
 
 
 if __name__ == '__main__':